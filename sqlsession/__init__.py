@@ -1,12 +1,24 @@
 from gevent import monkey
 
 monkey.patch_all()
+import collections
+import contextlib
+import hashlib
+import itertools
 import json
+import logging
+import random
 import re
+import time
 import urllib
 
+import gevent
+import gevent.event
+import gevent.lock
+import gevent.queue
 import gevent.socket
 import psycopg2.extensions
+import psycopg2.extras
 import sqlalchemy
 import sqlalchemy.engine
 from psycopg2.extensions import QuotedString as SqlString
@@ -30,6 +42,9 @@ except NameError:
     text = str
 
 
+logger = logging.getLogger(__name__)
+
+role_statement_re = re.compile(r"^\s*(re)?set\s+((session|local)\s+)?role\b", re.I)
 table_name_re = "^[a-zA-Z_ŠŽÁÂÂÉËÍÎÓÔŐÖÚÜÝßáäçéëíóôöúüý]+[a-zA-Z0-9_ŠŽÁÂÂÉËÍÎÓÔŐÖÚÜÝßáäçéëíóôöúüý]*$"
 
 # TODO: Lazy session !!!
@@ -144,6 +159,11 @@ def make_psycopg_green():
     psycopg2.extensions.set_wait_callback(gevent_wait_callback)
 
 
+# dbapi connection -> absolute time (time.time()) by which the running
+# statement has to finish, see statement_deadline()
+statement_deadlines = {}
+
+
 def gevent_wait_callback(
     conn,
     timeout=None,
@@ -153,18 +173,180 @@ def gevent_wait_callback(
     POLL_WRITE=psycopg2.extensions.POLL_WRITE,
     wait_read=gevent.socket.wait_read,
     wait_write=gevent.socket.wait_write,
+    socket_timeout=gevent.socket.timeout,
+    deadlines=statement_deadlines,
+    now=time.time,
 ):
-    """A wait callback useful to allow gevent to work with Psycopg."""
+    """A wait callback useful to allow gevent to work with Psycopg.
+
+    When a deadline is registered for the connection and it passes, the
+    statement is cancelled on the server and polling continues until the
+    backend reports the cancellation (QueryCanceledError).
+
+    NOTE: conn.cancel() is a blocking PQcancel call (new connection to the
+    server) that stalls the gevent hub until the cancel request is sent.
+    """
+    deadline = deadlines.get(conn)
+
     while 1:
         state = conn.poll()
         if state == POLL_OK:
             break
-        elif state == POLL_READ:
-            wait_read(conn.fileno(), timeout=timeout)
-        elif state == POLL_WRITE:
-            wait_write(conn.fileno(), timeout=timeout)
+
+        if deadline is not None:
+            timeout = max(deadline - now(), 0)
+
+        try:
+            if state == POLL_READ:
+                wait_read(conn.fileno(), timeout=timeout)
+            elif state == POLL_WRITE:
+                wait_write(conn.fileno(), timeout=timeout)
+            else:
+                raise psycopg2.OperationalError("Bad result from poll: %r" % state)
+
+        except socket_timeout:
+            if deadline is None:
+                raise
+
+            conn.cancel()
+            deadline = None
+            timeout = None
+
+
+# wait callback suspended by blocking_copy(), nested calls share it
+blocking_copy_state = {"count": 0, "callback": None}
+
+
+@contextlib.contextmanager
+def blocking_copy():
+    """Suspend the wait callback, psycopg2 refuses COPY in green mode.
+
+    The COPY runs as blocking libpq calls and stalls the gevent hub until done.
+    """
+    if blocking_copy_state["count"] == 0:
+        blocking_copy_state["callback"] = psycopg2.extensions.get_wait_callback()
+        psycopg2.extensions.set_wait_callback(None)
+
+    blocking_copy_state["count"] += 1
+
+    try:
+        yield
+
+    finally:
+        blocking_copy_state["count"] -= 1
+
+        if blocking_copy_state["count"] == 0:
+            psycopg2.extensions.set_wait_callback(blocking_copy_state["callback"])
+            blocking_copy_state["callback"] = None
+
+
+def statement_timeout_ms(timeout):
+    # 0 disables the limit on the server
+    return max(int(timeout * 1000), 1)
+
+
+@contextlib.contextmanager
+def statement_deadline(conn, timeout):
+    """Cancel statements running on dbapi connection after timeout seconds."""
+    if timeout is None:
+        yield
+        return
+
+    statement_deadlines[conn] = time.time() + timeout
+
+    try:
+        yield
+    finally:
+        statement_deadlines.pop(conn, None)
+
+
+def sql_fingerprint(sql):
+    """Hash of statement with literals and bind parameters replaced."""
+    normalized = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    normalized = re.sub(r"%\(\w+\)s|\b\d+(?:\.\d+)?\b", "?", normalized)
+    normalized = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(?)", normalized)
+    normalized = re.sub(r"\s+", " ", normalized).strip().lower()
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:16]
+
+
+def register_decoders(connection, decoding):
+    """Register typecasters selected by decoding policy on dbapi connection.
+
+    decoding is a dict with optional keys:
+      json - "raw" (str), "bytes" or loads callable (e.g. orjson.loads),
+             used for both json and jsonb
+      numeric - "float"
+      timestamp - "str", timestamp and timestamptz left as returned by server
+    """
+    json_policy = decoding.get("json")
+
+    if json_policy is not None:
+        if json_policy == "raw":
+            loads = text
+
+        elif json_policy == "bytes":
+            encoding = psycopg2.extensions.encodings[connection.encoding]
+
+            def loads(value):
+                return value.encode(encoding)
+
+        elif callable(json_policy):
+            loads = json_policy
+
         else:
-            raise psycopg2.OperationalError("Bad result from poll: %r" % state)
+            raise ValueError('json decoding must be "raw"/"bytes" or callable')
+
+        psycopg2.extras.register_json(connection, loads=loads, oid=114, array_oid=199)
+        psycopg2.extras.register_json(
+            connection, loads=loads, oid=3802, array_oid=3807, name="jsonb"
+        )
+
+    numeric_policy = decoding.get("numeric")
+
+    if numeric_policy is not None:
+        if numeric_policy != "float":
+            raise ValueError('numeric decoding must be "float"')
+
+        def cast_float(value, cursor):
+            if value is None:
+                return None
+
+            return float(value)
+
+        numeric = psycopg2.extensions.new_type((1700,), "NUMERIC_FLOAT", cast_float)
+        psycopg2.extensions.register_type(numeric, connection)
+        psycopg2.extensions.register_type(
+            psycopg2.extensions.new_array_type((1231,), "NUMERIC_FLOAT[]", numeric),
+            connection,
+        )
+
+    timestamp_policy = decoding.get("timestamp")
+
+    if timestamp_policy is not None:
+        if timestamp_policy != "str":
+            raise ValueError('timestamp decoding must be "str"')
+
+        def cast_str(value, cursor):
+            return value
+
+        timestamp = psycopg2.extensions.new_type(
+            (1114, 1184), "TIMESTAMP_STR", cast_str
+        )
+        psycopg2.extensions.register_type(timestamp, connection)
+        psycopg2.extensions.register_type(
+            psycopg2.extensions.new_array_type(
+                (1115, 1185), "TIMESTAMP_STR[]", timestamp
+            ),
+            connection,
+        )
+
+
+def get_decoding_key(decoding):
+    """Hashable form of decoding policy, connections are pooled per policy."""
+    if decoding is None:
+        return None
+
+    return tuple(sorted(decoding.items(), key=lambda item: item[0]))
 
 
 def preprocess_table_data(table, data):
@@ -243,6 +425,10 @@ class SqlSessionTooMany(Exception):
     pass
 
 
+class SqlSessionTimeout(Exception):
+    pass
+
+
 class NoticeCollector(object):
     def __init__(self):
         self.buf = []
@@ -271,35 +457,847 @@ class NoticeCollector(object):
         return self.buf.__setslice__(i, j, x)
 
 
+class BufferedWriter(object):
+    """Collects rows in memory and inserts them in batches from a greenlet.
+
+    Rows are flushed as multi-row inserts once max_rows are buffered or every
+    max_delay seconds. add() blocks while a full buffer waits for the previous
+    batch. Failed batches are passed to error_callback(exception, rows) or,
+    without callback, the first error is raised from add()/flush()/close().
+    failed_batches and failed_rows count all failures either way.
+    """
+
+    def __init__(
+        self, session, table, max_rows=5000, max_delay=0.5, error_callback=None
+    ):
+        self.session = session.clone(checkout_limited=False)
+        self.table = table
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.error_callback = error_callback
+        self.error = None
+        self.failed_batches = 0
+        self.failed_rows = 0
+        self.buffer = []
+        self.pending = 0
+        self.closed = True
+        self.greenlet = None
+        self.wakeup = gevent.event.Event()
+        self.flushed = gevent.event.Event()
+
+    def open(self):
+        self.session.connect()
+
+        try:
+            if isinstance(self.table, str) or isinstance(self.table, text):
+                self.table = self.session.get_table(self.table)
+
+        except Exception:
+            self.session.disconnect()
+            raise
+
+        self.closed = False
+        self.greenlet = gevent.spawn(self.run)
+        # wake up waiters even if flusher dies unexpectedly
+        self.greenlet.link(lambda greenlet: self.flushed.set())
+
+    def close(self, raise_error=True):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.wakeup.set()
+        self.greenlet.join()
+        self.session.disconnect()
+
+        if raise_error:
+            self.raise_error()
+
+        elif self.error is not None:
+            logger.error(
+                "Buffered writer to %s failed: %s (%d batches, %d rows lost)",
+                self.table,
+                self.error,
+                self.failed_batches,
+                self.failed_rows,
+            )
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close(raise_error=type is None)
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def add(self, row):
+        if self.closed:
+            raise RuntimeError("Writer is closed")
+
+        self.raise_error()
+
+        while len(self.buffer) >= self.max_rows:
+            self.wait_flush()
+            self.raise_error()
+
+        self.buffer.append(row)
+
+        if len(self.buffer) >= self.max_rows:
+            self.wakeup.set()
+
+    def flush(self):
+        while self.buffer or self.pending:
+            self.wait_flush()
+
+        self.raise_error()
+
+    def wait_flush(self):
+        if self.greenlet.dead:
+            raise RuntimeError("Writer flusher is not running")
+
+        self.flushed.clear()
+        self.wakeup.set()
+        self.flushed.wait()
+
+        if self.greenlet.dead:
+            raise RuntimeError("Writer flusher is not running")
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.max_delay)
+            self.wakeup.clear()
+            self.write()
+
+            if self.closed and not self.buffer:
+                break
+
+    def write(self):
+        rows, self.buffer = self.buffer, []
+        self.pending = len(rows)
+
+        try:
+            if rows:
+                self.insert(rows)
+
+        except Exception as e:
+            self.failed_batches += 1
+            self.failed_rows += len(rows)
+
+            if self.error_callback is not None:
+                try:
+                    self.error_callback(e, rows)
+
+                except Exception as callback_error:
+                    if self.error is None:
+                        self.error = callback_error
+
+            elif self.error is None:
+                self.error = e
+
+        finally:
+            self.pending = 0
+            self.flushed.set()
+
+    def insert(self, rows):
+        data = preprocess_table_data(self.table, rows)
+        # multi-row VALUES needs the same columns in every row
+        groups = itertools.groupby(data, lambda item: tuple(sorted(item)))
+
+        self.session.begin()
+
+        try:
+            for columns, group in groups:
+                self.session.execute(insert(self.table).values(list(group)))
+
+        except Exception:
+            self.session.rollback()
+            raise
+
+        self.session.end()
+
+
+class AutoExplain(object):
+    """Captures plans of slow or sampled statements of sessions using it.
+
+    Statements slower than threshold seconds, or a sample_rate fraction of all
+    statements, are explained on a spare connection in a separate greenlet.
+    SELECTs use EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON), writes and statements
+    cancelled by a deadline plain EXPLAIN.
+    Only one explain runs at a time, at most max_per_minute are started and
+    the same fingerprint is explained at most once per min_interval seconds.
+    The latest max_plans entries are kept in plans and passed to callback.
+    """
+
+    def __init__(
+        self,
+        threshold=1.0,
+        sample_rate=0.0,
+        callback=None,
+        max_plans=100,
+        max_per_minute=10,
+        min_interval=60.0,
+        timeout=30.0,
+    ):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.callback = callback
+        self.max_plans = max_plans
+        self.max_per_minute = max_per_minute
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self.plans = collections.OrderedDict()
+        self.started = collections.deque()
+        self.running = False
+
+    def observe(self, session, statement, elapsed, cancelled=False):
+        slow = self.threshold is not None and elapsed >= self.threshold
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+
+        if not (slow or sampled or cancelled) or self.running:
+            return
+
+        if session.database_type != "pgsql":
+            return
+
+        try:
+            self.start(session, statement, elapsed, cancelled)
+
+        except Exception:
+            # diagnostics must never affect the application
+            self.running = False
+
+    def start(self, session, statement, elapsed, cancelled):
+        if isinstance(statement, str) or isinstance(statement, text):
+            sql, params = statement, None
+        else:
+            compiled = statement.compile(dialect=session.engine.dialect)
+            sql, params = text(compiled), compiled.params
+
+        keyword = sql.lstrip().split(None, 1)[0].lower() if sql.strip() else ""
+
+        # cancelled statement would most likely hit the deadline again
+        if keyword == "select" and not cancelled:
+            analyze = True
+        elif keyword in ("select", "insert", "update", "delete", "with"):
+            analyze = False
+        else:
+            return
+
+        fingerprint = sql_fingerprint(sql)
+        now = time.time()
+        entry = self.plans.get(fingerprint)
+
+        if entry is not None and now - entry["timestamp"] < self.min_interval:
+            return
+
+        while self.started and now - self.started[0] > 60:
+            self.started.popleft()
+
+        if len(self.started) >= self.max_per_minute:
+            return
+
+        self.running = True
+
+        explain_session = session.clone(checkout_limited=False)
+        explain_session.auto_explain = None
+        gevent.spawn(
+            self.explain, explain_session, sql, params, fingerprint, elapsed, analyze
+        )
+        self.started.append(now)
+
+    def explain(self, session, sql, params, fingerprint, elapsed, analyze):
+        if analyze:
+            query = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql
+        else:
+            query = "EXPLAIN (FORMAT JSON) " + sql
+
+        try:
+            session.connect()
+
+            try:
+                dbapi_connection = session.connection.connection.connection
+                cursor = dbapi_connection.cursor()
+
+                try:
+                    with statement_deadline(dbapi_connection, self.timeout):
+                        cursor.execute(query, params)
+                        plan = cursor.fetchone()[0]
+
+                    # json may be left undecoded by connection decoding policy
+                    if not isinstance(plan, list):
+                        plan = json.loads(plan)
+
+                finally:
+                    cursor.close()
+                    # ANALYZE executes the statement, never keep its effects
+                    dbapi_connection.rollback()
+
+            finally:
+                session.disconnect()
+
+        except Exception:
+            # diagnostics must never affect the application
+            return
+
+        finally:
+            self.running = False
+
+        entry = {
+            "fingerprint": fingerprint,
+            "statement": sql,
+            "elapsed": elapsed,
+            "analyze": analyze,
+            "plan": plan,
+            "timestamp": time.time(),
+        }
+
+        self.plans.pop(fingerprint, None)
+        self.plans[fingerprint] = entry
+
+        while len(self.plans) > self.max_plans:
+            self.plans.popitem(last=False)
+
+        if self.callback is not None:
+            try:
+                self.callback(entry)
+
+            except Exception:
+                logger.exception("Auto explain callback failed")
+
+
+class ParallelScan(object):
+    """Reads a table in key ranges on several pooled connections at once.
+
+    The single integer primary key (or partition_by column) range is split
+    into chunks, without one the table is split by ctid blocks (requires TID
+    range scans of PostgreSQL 14+). Each of workers greenlets reads chunks on
+    its own cloned session and iteration yields lists of up to batch_size rows
+    as they arrive, at most max_buffered batches are held in flight. With
+    ordered batches are yielded in partition key order, each worker then keeps
+    at most max_buffered / workers batches of its chunk waiting for output.
+    With snapshot all workers share a snapshot exported by pg_export_snapshot().
+    """
+
+    def __init__(
+        self,
+        session,
+        table,
+        condition=None,
+        workers=4,
+        partition_by=None,
+        chunks=None,
+        batch_size=1000,
+        ordered=False,
+        max_buffered=None,
+        snapshot=True,
+    ):
+        self.session = session
+        self.table = table
+        self.condition = condition
+        self.workers = workers
+        self.partition_by = partition_by
+        self.chunks = chunks or workers * 4
+        self.batch_size = batch_size
+        self.ordered = ordered
+        self.max_buffered = max_buffered or workers * 2
+        self.snapshot = snapshot
+        self.order = None
+        self.slots = None
+        self.stopped = False
+
+    def __iter__(self):
+        coordinator = self.session.clone(checkout_limited=False)
+        coordinator.auto_explain = None
+        coordinator.connect()
+        workers = []
+        self.stopped = False
+
+        try:
+            self.begin_transaction(coordinator, self.snapshot)
+
+            if self.snapshot:
+                snapshot_id = coordinator.one("SELECT pg_export_snapshot() AS id")["id"]
+
+            else:
+                snapshot_id = None
+
+            table = self.table
+
+            if isinstance(table, str) or isinstance(table, text):
+                table = coordinator.get_table(table)
+
+            chunks = self.get_chunks(coordinator, table)
+            chunk_queue = gevent.queue.Queue()
+
+            for chunk in enumerate(chunks):
+                chunk_queue.put(chunk)
+
+            workers_count = self.workers
+
+            # workers are not counted by role_max_connections, cap them instead
+            if not self.session.dont_pool:
+                limit = self.session.engine_pool.get_role_limit(self.session.as_role)
+
+                if limit is not None:
+                    workers_count = max(min(workers_count, limit), 1)
+
+            if self.ordered:
+                per_chunk = max(self.max_buffered // workers_count, 1)
+                self.slots = [gevent.lock.Semaphore(per_chunk) for chunk in chunks]
+
+            batches = gevent.queue.Queue(maxsize=self.max_buffered)
+
+            for i in range(min(workers_count, chunk_queue.qsize())):
+                workers.append(
+                    gevent.spawn(self.scan, table, chunk_queue, batches, snapshot_id)
+                )
+
+            running = len(workers)
+            pending = {}
+            next_index = 0
+
+            while running:
+                index, batch = batches.get()
+
+                if index is None:
+                    running -= 1
+
+                    if batch is not None:
+                        raise batch
+
+                elif not self.ordered:
+                    if batch is not None:
+                        yield batch
+
+                else:
+                    # None marks the end of chunk
+                    pending.setdefault(index, []).append(batch)
+
+                    while pending.get(next_index):
+                        batch = pending[next_index].pop(0)
+
+                        if batch is None:
+                            del pending[next_index]
+                            next_index += 1
+                        else:
+                            yield batch
+                            self.slots[next_index].release()
+
+        finally:
+            self.stopped = True
+
+            # workers may wait for free space in the queue
+            while not all(worker.dead for worker in workers):
+                try:
+                    batches.get(timeout=0.1)
+                except gevent.queue.Empty:
+                    pass
+
+            coordinator.rollback()
+            coordinator.disconnect()
+
+    def get_chunks(self, session, table):
+        if self.partition_by == "ctid":
+            return self.get_block_chunks(session, table)
+
+        if self.partition_by is not None:
+            column = getattr(table.columns, self.partition_by)
+
+        else:
+            pkeys = list(table.primary_key.columns)
+
+            if len(pkeys) != 1 or not isinstance(
+                pkeys[0].type, sqlalchemy.types.Integer
+            ):
+                return self.get_block_chunks(session, table)
+
+            column = pkeys[0]
+
+        if not isinstance(column.type, sqlalchemy.types.Integer):
+            raise ValueError("partition_by must be integer column or 'ctid'")
+
+        self.order = column
+        stmt = select([func.min(column), func.max(column)]).select_from(table)
+        condition = self.condition
+
+        if isinstance(condition, dict):
+            condition = build_condition_from_dict(table, condition)
+
+        if condition is not None:
+            stmt = stmt.where(condition)
+
+        low, high = list(session.run(stmt))[0]
+
+        chunks = []
+
+        if low is not None:
+            step = max((high - low + self.chunks) // self.chunks, 1)
+            starts = list(range(low, high + 1, step))
+
+            for start, end in zip(starts, starts[1:]):
+                chunks.append(and_(column >= start, column < end))
+
+            chunks.append(column >= starts[-1])
+
+        if column.nullable:
+            chunks.append(column.is_(None))
+
+        return chunks
+
+    def get_block_chunks(self, session, table):
+        version = session.one(
+            "SELECT current_setting('server_version_num') AS version"
+        )["version"]
+
+        # without TID range scan every chunk would be a full sequential scan
+        if int(version) < 140000:
+            raise ValueError(
+                "Scan by ctid requires PostgreSQL 14+, use integer partition_by"
+            )
+
+        self.order = text_statement("ctid")
+        name = session.engine.dialect.identifier_preparer.format_table(table)
+        stmt = text_statement(
+            "SELECT pg_relation_size(CAST(:name AS regclass)) "
+            "/ CAST(current_setting('block_size') AS integer) AS blocks"
+        ).bindparams(name=name)
+        blocks = session.one(stmt)["blocks"]
+
+        if blocks == 0:
+            return [sqlalchemy.true()]
+
+        step = max((blocks + self.chunks - 1) // self.chunks, 1)
+        starts = list(range(0, blocks, step))
+        chunks = []
+
+        for start, end in zip(starts, starts[1:]):
+            chunks.append(
+                text_statement(
+                    "ctid >= CAST(:low AS tid) AND ctid < CAST(:high AS tid)"
+                ).bindparams(low="(%d,0)" % start, high="(%d,0)" % end)
+            )
+
+        # rows of pages appended since the size was read are in the last chunk
+        chunks.append(
+            text_statement("ctid >= CAST(:low AS tid)").bindparams(
+                low="(%d,0)" % starts[-1]
+            )
+        )
+
+        return chunks
+
+    def begin_transaction(self, session, repeatable_read):
+        """Start real transaction, needed for snapshots and streamed cursors."""
+        # execute() commits with "commit;" behind psycopg2's back, so it would
+        # not send BEGIN for the next statement without syncing its state
+        session.connection.connection.commit()
+        session.begin()
+
+        if repeatable_read:
+            session.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+
+    def acquire_slot(self, index):
+        """Wait until batch of chunk index may be buffered for ordered output."""
+        while not self.slots[index].acquire(timeout=0.1):
+            if self.stopped:
+                return False
+
+        return True
+
+    def scan(self, table, chunk_queue, batches, snapshot_id):
+        session = self.session.clone(checkout_limited=False)
+        session.auto_explain = None
+        connected = False
+        error = None
+
+        try:
+            session.connect()
+            connected = True
+            self.begin_transaction(session, snapshot_id is not None)
+
+            if snapshot_id is not None:
+                if not re.match("^[0-9A-Fa-f-]+$", snapshot_id):
+                    raise ValueError("Unexpected snapshot id %s" % snapshot_id)
+
+                session.execute("SET TRANSACTION SNAPSHOT '%s'" % snapshot_id)
+
+            connection = session.connection.execution_options(stream_results=True)
+            row_factory = session.get_row_factory()
+
+            while not self.stopped and not chunk_queue.empty():
+                index, chunk = chunk_queue.get()
+                stmt = session.get_statement(table, self.condition, None).where(chunk)
+
+                if self.ordered:
+                    stmt = stmt.order_by(self.order)
+
+                result = connection.execute(stmt)
+
+                while not self.stopped:
+                    rows = result.fetchmany(self.batch_size)
+
+                    if not rows:
+                        break
+
+                    if self.ordered and not self.acquire_slot(index):
+                        break
+
+                    batches.put((index, list(map(row_factory, rows))))
+
+                result.close()
+                batches.put((index, None))
+
+        except Exception as e:
+            error = e
+
+        finally:
+            try:
+                if connected:
+                    session.rollback()
+                    session.disconnect()
+
+            finally:
+                batches.put((None, error))
+
+
 class EnginePool(object):
-    def __init__(self, param=None, pool_size=5):
+    """Pool of (engine, metadata, connection) tuples for one database.
+
+    With partition_roles idle connections are kept in sub-pools by the role
+    set on them, so a connection already having the requested role is handed
+    out without SET/RESET role. The role is switched only when a connection
+    moves between roles. role_pool_size (int or dict role -> int) limits idle
+    connections kept per role, extra ones are reset to the default pool.
+    role_max_connections (int or dict role -> int) limits connections checked
+    out per role, get_connection() waits for a free one above the limit.
+    Internal clones (buffered writer, auto explain, parallel scan) are not
+    counted, they are taken while the parent session holds its connection.
+    """
+
+    def __init__(
+        self,
+        param=None,
+        pool_size=5,
+        partition_roles=None,
+        role_pool_size=None,
+        role_max_connections=None,
+    ):
         self.database_type = get_value(param, ["type", "db_type"], "pgsql")
         self.param = param
         self.pool_size = pool_size
         self.used_pool = set()
         self.unused_pool = set()
 
-    def get_connection(self):
-        if len(self.unused_pool) >= 1:
+        if partition_roles is None:
+            partition_roles = get_value(param, ["partition_roles"], False)
+
+        if role_pool_size is None:
+            role_pool_size = get_value(param, ["role_pool_size"], pool_size)
+
+        if role_max_connections is None:
+            role_max_connections = get_value(param, ["role_max_connections"])
+
+        self.partition_roles = partition_roles
+        self.role_pool_size = role_pool_size
+        self.role_max_connections = role_max_connections
+        self.role_semaphores = {}
+        self.checkout_roles = {}
+        self.connection_timeouts = {}
+        self.decoding = get_value(param, ["decoding"])
+        self.role_pools = {}
+        self.connection_roles = {}
+        self.role_reuses = collections.Counter()
+        self.role_switches = collections.Counter()
+
+    def get_connection(self, role=None, statement_timeout=None, limited=True):
+        if self.partition_roles:
+            semaphore = self.get_role_semaphore(role) if limited else None
+
+            if semaphore is not None:
+                semaphore.acquire()
+
+            try:
+                used = self.get_role_connection(role)
+
+            except Exception:
+                if semaphore is not None:
+                    semaphore.release()
+                raise
+
+            if semaphore is not None:
+                self.checkout_roles[used] = role
+
+        elif len(self.unused_pool) >= 1:
             used = self.unused_pool.pop()
-            self.used_pool.add(used)
 
         else:
             used = self.connect()
-            self.used_pool.add(used)
 
+        try:
+            self.switch_statement_timeout(used, statement_timeout)
+
+        except Exception:
+            self.discard_connection(used)
+            raise
+
+        self.used_pool.add(used)
         return used
 
+    def get_role_connection(self, role):
+        if role is None:
+            idle = self.unused_pool
+
+        elif not re.match("^[a-zA-Z_][a-zA-Z0-9_]*$", role):
+            raise ValueError("Role name can contain only letters and numbers")
+
+        else:
+            idle = self.role_pools.get(role)
+
+        if idle:
+            self.role_reuses[role] += 1
+            return idle.pop()
+
+        if len(self.unused_pool) >= 1:
+            used = self.unused_pool.pop()
+
+        else:
+            other_roles = [pool for pool in self.role_pools.values() if pool]
+
+            if other_roles:
+                used = max(other_roles, key=len).pop()
+            else:
+                used = self.connect()
+
+        if self.connection_roles.get(used) != role:
+            try:
+                self.switch_role(used, role)
+
+            except Exception:
+                # e.g. role does not exist, don't leak the physical connection
+                self.discard_connection(used)
+                raise
+
+            self.role_switches[role] += 1
+
+        return used
+
+    def get_role_limit(self, role):
+        if not self.partition_roles:
+            return None
+
+        if isinstance(self.role_max_connections, dict):
+            return self.role_max_connections.get(role)
+
+        return self.role_max_connections
+
+    def get_role_semaphore(self, role):
+        limit = self.get_role_limit(role)
+
+        if limit is None:
+            return None
+
+        if role not in self.role_semaphores:
+            self.role_semaphores[role] = gevent.lock.BoundedSemaphore(limit)
+
+        return self.role_semaphores[role]
+
+    def track_role(self, used, role):
+        """Record role set on checked out connection outside of the pool."""
+        if role is None:
+            self.connection_roles.pop(used, None)
+        else:
+            self.connection_roles[used] = role
+
+    def get_role_pool_size(self, role):
+        if isinstance(self.role_pool_size, dict):
+            return self.role_pool_size.get(role, self.pool_size)
+
+        return self.role_pool_size
+
+    def switch_statement_timeout(self, used, timeout):
+        """Set statement_timeout once per physical connection, not per checkout."""
+        if self.database_type != "pgsql":
+            return
+
+        value = None if timeout is None else statement_timeout_ms(timeout)
+
+        if self.connection_timeouts.get(used) == value:
+            return
+
+        connection = used[2]
+
+        if value is None:
+            connection.execute("RESET statement_timeout")
+        else:
+            connection.execute("SET statement_timeout = %d" % value)
+
+        connection.execute("commit;")
+        self.track_statement_timeout(used, value)
+
+    def track_statement_timeout(self, used, value):
+        """Record statement_timeout (ms) set on connection outside of the pool."""
+        if value is None:
+            self.connection_timeouts.pop(used, None)
+        else:
+            self.connection_timeouts[used] = value
+
+    def discard_connection(self, used):
+        self.used_pool.discard(used)
+        self.connection_roles.pop(used, None)
+        self.connection_timeouts.pop(used, None)
+
+        if used in self.checkout_roles:
+            semaphore = self.role_semaphores.get(self.checkout_roles.pop(used))
+
+            if semaphore is not None:
+                semaphore.release()
+
+        used[2].close()
+        used[0].dispose()
+
+    def switch_role(self, used, role):
+        connection = used[2]
+
+        if role is None:
+            connection.execute("RESET role")
+            self.connection_roles.pop(used, None)
+
+        else:
+            connection.execute("SET role=%s" % role)
+            self.connection_roles[used] = role
+
+        connection.execute("commit;")
+
     def free_connection(self, used):
         # TODO: once working put into try except ValueError
         self.used_pool.remove(used)
 
         if len(self.used_pool) >= self.pool_size:
-            used[2].close()
-            used[0].dispose()
-        else:
+            self.discard_connection(used)
+            return
+
+        if used in self.checkout_roles:
+            semaphore = self.role_semaphores.get(self.checkout_roles.pop(used))
+
+            if semaphore is not None:
+                semaphore.release()
+
+        role = self.connection_roles.get(used)
+
+        if role is None:
             self.unused_pool.add(used)
 
+        elif len(self.role_pools.get(role, ())) >= self.get_role_pool_size(role):
+            self.switch_role(used, None)
+            self.unused_pool.add(used)
+
+        else:
+            self.role_pools.setdefault(role, set()).add(used)
+
     def connect(self):
         url = build_url(self.param)
         engine = create_engine(url)
@@ -309,6 +1307,9 @@ class EnginePool(object):
         if get_value(self.param, ["type", "db_type"], "pgsql"):
             connection.connection.connection.notices = NoticeCollector()
 
+        if self.decoding is not None and self.database_type == "pgsql":
+            register_decoders(connection.connection.connection, self.decoding)
+
         return (engine, metadata, connection)
 
     def dispose_pool(self):
@@ -319,10 +1320,28 @@ engine_pools = {}
 
 
 class SqlSession(object):
-    def __init__(self, param=None, as_role=None, connect_args=None, dont_pool=False):
+    def __init__(
+        self,
+        param=None,
+        as_role=None,
+        connect_args=None,
+        dont_pool=False,
+        statement_timeout=None,
+        auto_explain=None,
+        column_decoders=None,
+        checkout_limited=True,
+    ):
         self.column_names = None
         self.transaction = None
+        self.param = param
+        self.connect_args = connect_args
         self.as_role = as_role
+        self.statement_timeout = statement_timeout
+        self.auto_explain = auto_explain
+        self.column_decoders = column_decoders
+        self.decoding = None
+        self.role_changed = False
+        self.checkout_limited = checkout_limited
         self.database_type = "pgsql"
         self.disposable = False
         self.dont_pool = dont_pool
@@ -335,6 +1354,7 @@ class SqlSession(object):
 
         elif dont_pool or connect_args is not None:
             self.database_type = get_value(param, ["type", "db_type"], "pgsql")
+            self.decoding = get_value(param, ["decoding"])
             url = build_url(param)
             self.engine = create_engine(url, connect_args)
             self.metadata = sqlalchemy.MetaData(self.engine)
@@ -349,6 +1369,12 @@ class SqlSession(object):
             else:
                 key = param["secret_arn"]
 
+            # typecasters are registered per physical connection
+            decoding = get_value(param, ["decoding"])
+
+            if decoding is not None:
+                key = (key, get_decoding_key(decoding))
+
             if key in engine_pools:
                 self.engine_pool = engine_pools[key]
 
@@ -356,6 +1382,8 @@ class SqlSession(object):
                 self.engine_pool = EnginePool(param)
                 engine_pools[key] = self.engine_pool
 
+            self.decoding = self.engine_pool.decoding
+
     def connect(self):
         if self.dont_pool:
             self.connection = self.engine.connect()
@@ -363,15 +1391,31 @@ class SqlSession(object):
             if self.database_type == "pgsql":
                 self.connection.connection.connection.notices = NoticeCollector()
 
+            if self.decoding is not None and self.database_type == "pgsql":
+                register_decoders(self.connection.connection.connection, self.decoding)
+
         else:
             (
                 self.engine,
                 self.metadata,
                 self.connection,
-            ) = self.engine_pool.get_connection()
+            ) = self.engine_pool.get_connection(
+                self.as_role, self.statement_timeout, self.checkout_limited
+            )
 
-        if self.as_role is not None:
-            self.set_role(self.as_role)
+        self.role_changed = False
+
+        with self.without_auto_explain():
+            if self.as_role is not None and not self.pooled_role():
+                self.set_role(self.as_role)
+
+            # pooled connections get statement_timeout from the pool
+            if (
+                self.dont_pool
+                and self.statement_timeout is not None
+                and self.database_type == "pgsql"
+            ):
+                self.set_statement_timeout(self.statement_timeout)
 
     def disconnect(self):
         if self.dont_pool:
@@ -384,8 +1428,17 @@ class SqlSession(object):
                 self.engine.dispose()
 
         else:
-            self.drop_temp_tables()
-            self.reset_role()
+            # transaction may be aborted (e.g. by SqlSessionTimeout), connection
+            # has to go back to the pool clean
+            self.rollback()
+
+            with self.without_auto_explain():
+                self.drop_temp_tables()
+
+                # role changed by raw SQL is unknown to the pool
+                if not self.pooled_role() or self.role_changed:
+                    self.reset_role()
+
             self.engine_pool.free_connection(
                 (self.engine, self.metadata, self.connection)
             )
@@ -397,6 +1450,33 @@ class SqlSession(object):
     def __exit__(self, type, value, traceback):
         self.disconnect()
 
+    @contextlib.contextmanager
+    def without_auto_explain(self):
+        """Keep internal bookkeeping statements out of auto explain samples."""
+        auto_explain, self.auto_explain = self.auto_explain, None
+
+        try:
+            yield
+        finally:
+            self.auto_explain = auto_explain
+
+    def clone(self, checkout_limited=True):
+        """Create unconnected session with the same engine/pool and settings.
+
+        Internal clones taken while this session is connected pass
+        checkout_limited=False to stay out of role_max_connections.
+        """
+        return SqlSession(
+            self.param,
+            as_role=self.as_role,
+            connect_args=self.connect_args,
+            dont_pool=self.dont_pool,
+            statement_timeout=self.statement_timeout,
+            auto_explain=self.auto_explain,
+            column_decoders=self.column_decoders,
+            checkout_limited=checkout_limited,
+        )
+
     def begin(self):
         self.transaction = self.connection.begin()
 
@@ -412,15 +1492,91 @@ class SqlSession(object):
             self.transaction.close()
             self.transaction = None
 
-    def execute(self, statement):
+    def run(self, statement, timeout=None):
+        # per-call timeout is also set on the server, at the cost of two extra
+        # round trips, session timeout is set once per physical connection
+        local_timeout = timeout is not None
+
+        if timeout is None:
+            timeout = self.statement_timeout
+
+        started = time.time()
+
+        if isinstance(statement, str) and role_statement_re.match(statement):
+            self.role_changed = True
+
+        if timeout is None or self.database_type != "pgsql":
+            result = self.connection.execute(statement)
+
+        else:
+            try:
+                result = self.run_with_deadline(statement, timeout, local_timeout)
+
+            except SqlSessionTimeout:
+                if self.auto_explain is not None:
+                    self.auto_explain.observe(
+                        self, statement, time.time() - started, cancelled=True
+                    )
+                raise
+
+        if self.auto_explain is not None:
+            self.auto_explain.observe(self, statement, time.time() - started)
+
+        return result
+
+    def run_with_deadline(self, statement, timeout, local_timeout=False):
+        # SET LOCAL is not used, after execute() commits with "commit;" psycopg2
+        # sends no BEGIN and the server would ignore it outside of transaction
+        if local_timeout:
+            self.connection.execute(
+                "SET statement_timeout = %d" % statement_timeout_ms(timeout)
+            )
+
+        try:
+            with statement_deadline(self.connection.connection.connection, timeout):
+                return self.connection.execute(statement)
+
+        except sqlalchemy.exc.DBAPIError as e:
+            if not isinstance(e.orig, psycopg2.extensions.QueryCanceledError):
+                raise
+
+            # NOTE: explicit transaction is left aborted, every following
+            # statement fails until the caller calls rollback()
+            raise SqlSessionTimeout(
+                "Statement cancelled after %s seconds: %s"
+                % (timeout, text(e.orig).strip())
+            )
+
+        finally:
+            if local_timeout:
+                self.restore_statement_timeout()
+
+    def restore_statement_timeout(self):
+        try:
+            if self.statement_timeout is None:
+                self.connection.execute("RESET statement_timeout")
+            else:
+                self.connection.execute(
+                    "SET statement_timeout = %d"
+                    % statement_timeout_ms(self.statement_timeout)
+                )
+
+        except sqlalchemy.exc.DBAPIError:
+            # aborted transaction, -1 never matches so pool sets it on checkout
+            if not self.dont_pool:
+                self.engine_pool.track_statement_timeout(
+                    (self.engine, self.metadata, self.connection), -1
+                )
+
+    def execute(self, statement, timeout=None):
         # if isinstance(statement, text):
         #    statement = text_statement(statement)
 
         if self.transaction is not None:
-            return self.connection.execute(statement)
+            return self.run(statement, timeout)
 
         else:
-            result = self.connection.execute(statement)
+            result = self.run(statement, timeout)
             self.connection.execute("commit;")
             return result
 
@@ -432,9 +1588,36 @@ class SqlSession(object):
             self.connection.execute("commit;")
 
     def get_unbound_connection(self):
-        return self.engine.contextual_connect(close_with_result=True).execution_options(
-            stream_results=True
-        )
+        connection = self.engine.contextual_connect(
+            close_with_result=True
+        ).execution_options(stream_results=True)
+
+        if self.decoding is not None and self.database_type == "pgsql":
+            register_decoders(connection.connection.connection, self.decoding)
+
+        return connection
+
+    def decode_row(self, row):
+        """Apply column_decoders to values returned by connection typecasters.
+
+        Decoders for json/jsonb columns need "decoding": {"json": "raw"} (or
+        "bytes"), otherwise they get values already decoded by stdlib json.
+        """
+        row = dict(row)
+
+        for key, decoder in self.column_decoders.items():
+            value = row.get(key)
+
+            if value is not None:
+                row[key] = decoder(value)
+
+        return row
+
+    def get_row_factory(self):
+        if self.column_decoders:
+            return self.decode_row
+
+        return dict
 
     def get_table(self, schema_table_name):
         t = schema_table_name.split(".")
@@ -458,7 +1641,7 @@ class SqlSession(object):
         else:
             raise ValueError("schema_table_name")
 
-    def update(self, table, data, condition=None):
+    def update(self, table, data, condition=None, timeout=None):
         if isinstance(table, str):
             table = self.get_table(table)
 
@@ -470,30 +1653,60 @@ class SqlSession(object):
 
         data = preprocess_table_data(table, data)
         stmt = update(table).where(condition).values(data[0])
-        return self.execute(stmt)
+        return self.execute(stmt, timeout)
 
-    def insert(self, table, data):
+    def insert(self, table, data, timeout=None):
         if isinstance(table, str):
             table = self.get_table(table)
 
         data = preprocess_table_data(table, data)
         stmt = insert(table, list(data), returning=table.primary_key.columns)
-        return self.execute(stmt)
+        return self.execute(stmt, timeout)
 
-    def delete(self, table, condition=None):
+    def delete(self, table, condition=None, timeout=None):
         if isinstance(table, str):
             table = self.get_table(table)
 
         if isinstance(condition, dict):
             condition = build_condition_from_dict(table, condition)
             stmt = delete(table).where(condition)
-            return self.execute(stmt)
+            return self.execute(stmt, timeout)
+
+    def buffered_writer(
+        self, table, max_rows=5000, max_delay=0.5, error_callback=None
+    ):
+        return BufferedWriter(self, table, max_rows, max_delay, error_callback)
+
+    def parallel_scan(
+        self,
+        table,
+        condition=None,
+        workers=4,
+        partition_by=None,
+        chunks=None,
+        batch_size=1000,
+        ordered=False,
+        max_buffered=None,
+        snapshot=True,
+    ):
+        return ParallelScan(
+            self,
+            table,
+            condition=condition,
+            workers=workers,
+            partition_by=partition_by,
+            chunks=chunks,
+            batch_size=batch_size,
+            ordered=ordered,
+            max_buffered=max_buffered,
+            snapshot=snapshot,
+        )
 
     def truncate(self, table):
         raise RuntimeError("Not yet inmplement")
 
     def get_statement(self, table, condition, order):
-        if isinstance(table, str) or isinstance(table, unicode):
+        if isinstance(table, str) or isinstance(table, text):
             table = self.get_table(table)
 
         stmt = table.select()
@@ -509,7 +1722,7 @@ class SqlSession(object):
 
         return stmt
 
-    def fetch_one(self, table, condition):
+    def fetch_one(self, table, condition, timeout=None):
         if isinstance(table, str) or isinstance(table, unicode):
             table = self.get_table(table)
 
@@ -521,9 +1734,9 @@ class SqlSession(object):
         if condition is not None:
             stmt = stmt.where(condition)
 
-        return self.one(stmt)
+        return self.one(stmt, timeout)
 
-    def fetch_maybe(self, table, condition):
+    def fetch_maybe(self, table, condition, timeout=None):
         if isinstance(table, str) or isinstance(table, unicode):
             table = self.get_table(table)
 
@@ -535,20 +1748,113 @@ class SqlSession(object):
         if condition is not None:
             stmt = stmt.where(condition)
 
-        return self.maybe(stmt)
+        return self.maybe(stmt, timeout)
 
-    def fetch_all(self, table, condition=None, order=None):
+    def fetch_all(self, table, condition=None, order=None, timeout=None):
         stmt = self.get_statement(table, condition, order)
-        return self.all(stmt)
+        return self.all(stmt, timeout)
 
     def iter_all(self, table, condition=None, order=None):
         stmt = self.get_statement(table, condition, order)
         connection = self.get_unbound_connection()
         data = connection.execute(stmt)
-        result = map(dict, data)
+        result = map(self.get_row_factory(), data)
         return result
 
-    def count(self, table, condition=None):
+    def export(
+        self,
+        table,
+        fileobj,
+        format="csv",
+        condition=None,
+        order=None,
+        header=True,
+        timeout=None,
+    ):
+        """Stream result of COPY (SELECT ...) TO STDOUT into fileobj.
+
+        table is a table name, Table or a select statement (condition and order
+        apply to tables only). A plain string is always a table name, raw SQL
+        has to be wrapped in sqlalchemy text(). Data is written in chunks as
+        they arrive, as str for text files and as bytes otherwise. Returns
+        number of rows copied.
+
+        NOTE: psycopg2 does not support COPY with the gevent wait callback, the
+        export blocks the whole gevent hub until it finishes. timeout is
+        enforced by the server only.
+        """
+        if isinstance(table, (str, text, Table)):
+            statement = self.get_statement(table, condition, order)
+        else:
+            statement = table
+
+        dbapi_connection = self.connection.connection.connection
+        cursor = dbapi_connection.cursor()
+
+        compiled = statement.compile(dialect=self.engine.dialect)
+        query = cursor.mogrify(text(compiled), compiled.params)
+
+        if format == "csv":
+            options = "FORMAT csv, HEADER %s" % ("true" if header else "false")
+
+        elif format == "text":
+            options = "FORMAT text"
+
+        elif format == "binary":
+            options = "FORMAT binary"
+
+        elif format == "jsonl":
+            # row_to_json keeps column order but copies json typed values
+            # verbatim, raw newlines can only be whitespace there (strings have
+            # them escaped). Single line json never contains these control
+            # characters, so csv with them as quote/delimiter passes rows
+            # through without text format escaping
+            query = (
+                b"SELECT translate(CAST(row_to_json(r) AS text), E'\\n\\r', '  ') "
+                b"FROM (" + query + b") AS r"
+            )
+            options = "FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02'"
+
+        else:
+            raise ValueError("format must be eighter csv/text/binary/jsonl")
+
+        query = b"COPY (" + query + b") TO STDOUT WITH (" + options.encode() + b")"
+
+        # wait callback (client deadline) can't be used, set it on the server
+        if timeout is not None:
+            self.connection.execute(
+                "SET statement_timeout = %d" % statement_timeout_ms(timeout)
+            )
+
+        try:
+            with blocking_copy():
+                cursor.copy_expert(query, fileobj)
+            rowcount = cursor.rowcount
+
+        except Exception as e:
+            # explicit transaction is left aborted for the caller to rollback()
+            if self.transaction is None:
+                self.connection.execute("rollback;")
+
+            if isinstance(e, psycopg2.extensions.QueryCanceledError):
+                raise SqlSessionTimeout(
+                    "Statement cancelled after %s seconds: %s"
+                    % (timeout or self.statement_timeout, text(e).strip())
+                )
+            raise
+
+        finally:
+            cursor.close()
+
+            if timeout is not None:
+                self.restore_statement_timeout()
+
+        if self.transaction is None:
+            self.connection.execute("commit;")
+
+        return rowcount
+
+    def count(self, table, condition=None, timeout=None):
         if isinstance(table, str) or isinstance(table, unicode):
             table = self.get_table(table)
 
@@ -559,11 +1865,11 @@ class SqlSession(object):
         else:
             stmt = select([func.count("*")]).select_from(table)
 
-        data = self.connection.execute(stmt)
+        data = self.run(stmt, timeout)
         data = list(data)[0][0]
         return data
 
-    def max(self, table, column_name, condition):
+    def max(self, table, column_name, condition, timeout=None):
         if isinstance(table, str) or isinstance(table, unicode):
             table = self.get_table(table)
 
@@ -571,11 +1877,11 @@ class SqlSession(object):
             condition = build_condition_from_dict(table, condition)
 
         stmt = select([func.max(column_name)]).where(condition)
-        data = self.connection.execute(stmt)
+        data = self.run(stmt, timeout)
         data = list(data)[0][0]
         return data
 
-    def min(self, table, column_name, condition):
+    def min(self, table, column_name, condition, timeout=None):
         if isinstance(table, str) or isinstance(table, unicode):
             table = self.get_table(table)
 
@@ -583,14 +1889,14 @@ class SqlSession(object):
             condition = build_condition_from_dict(table, condition)
 
         stmt = select([func.min(column_name)]).where(condition)
-        data = self.connection.execute(stmt)
+        data = self.run(stmt, timeout)
         data = list(data)[0][0]
         return data
 
-    def one(self, statement):
-        data = self.connection.execute(statement)
+    def one(self, statement, timeout=None):
+        data = self.run(statement, timeout)
         self.column_names = data.keys()
-        data = list(map(dict, data))
+        data = list(map(self.get_row_factory(), data))
 
         if len(data) > 1:
             raise SqlSessionTooMany("Expected exaclty one record, %s found" % len(data))
@@ -600,10 +1906,10 @@ class SqlSession(object):
 
         return data[0]
 
-    def maybe(self, statement):
-        data = self.connection.execute(statement)
+    def maybe(self, statement, timeout=None):
+        data = self.run(statement, timeout)
         self.column_names = data.keys()
-        data = list(map(dict, data))
+        data = list(map(self.get_row_factory(), data))
 
         if len(data) > 1:
             raise SqlSessionTooMany("Expected exaclty one record, %s found" % len(data))
@@ -613,10 +1919,10 @@ class SqlSession(object):
 
         return data[0]
 
-    def all(self, statement):
-        data = self.connection.execute(statement)
+    def all(self, statement, timeout=None):
+        data = self.run(statement, timeout)
         self.column_names = data.keys()
-        result = list(map(dict, data))
+        result = list(map(self.get_row_factory(), data))
         return result
 
     def drop_table(self, table, cascade=False):
@@ -715,15 +2021,48 @@ class SqlSession(object):
 
         self.execute("DROP GROUP %s" % group_name)
 
+    def pooled_role(self):
+        """True when the role is set by role-partitioned engine pool."""
+        return not self.dont_pool and self.engine_pool.partition_roles
+
     def set_role(self, user_name):
         if not re.match("[a-zA-Z0-9]*", user_name):
             raise ValueError("User name can contain only letters and numbers")
 
         self.execute("SET role=%s" % user_name)
 
+        if self.pooled_role():
+            self.engine_pool.track_role(
+                (self.engine, self.metadata, self.connection), user_name
+            )
+            self.role_changed = False
+
     def reset_role(self):
         self.execute("RESET role")
 
+        if self.pooled_role():
+            self.engine_pool.track_role(
+                (self.engine, self.metadata, self.connection), None
+            )
+            self.role_changed = False
+
+    def set_statement_timeout(self, timeout):
+        value = statement_timeout_ms(timeout)
+        self.execute("SET statement_timeout = %d" % value)
+
+        if not self.dont_pool and self.transaction is None:
+            self.engine_pool.track_statement_timeout(
+                (self.engine, self.metadata, self.connection), value
+            )
+
+    def reset_statement_timeout(self):
+        self.execute("RESET statement_timeout")
+
+        if not self.dont_pool and self.transaction is None:
+            self.engine_pool.track_statement_timeout(
+                (self.engine, self.metadata, self.connection), None
+            )
+
     def grant_role(self, user_name, target_role):
         if not re.match("[a-zA-Z][a-zA-Z0-9_]*", user_name):
             raise ValueError("User name can contain only letters and numbers")